@@ -1,9 +1,12 @@
+import os
+
 import mlflow
 import torch
+import torch.distributed as dist
 from cortex._lib import exp
 from torch.backends import cudnn
 import torch.nn.functional as F
-from torch.nn import DataParallel
+from torch.nn.parallel import DistributedDataParallel
 import numpy as np
 from torchsummary import summary
 
@@ -33,7 +36,7 @@ class FixMatchController(MixMatchController):
             targets_l = self.inputs('data.targets')
             inputs_l = self.inputs('data.images')
 
-            self.losses.classifier = torch.tensor(0.0).to(exp.DEVICE)
+            self.losses.classifier = self._zero_loss
 
             with torch.no_grad():
                 outputs_l = self.nets.ema_classifier(inputs_l)
@@ -62,9 +65,9 @@ class FixMatchController(MixMatchController):
             # record loss
             self.losses.classifier = Ll + lambda_u * Lu
 
-            # Write res
-            self.add_results(losses_l=Ll.item())
-            self.add_results(losses_u=Lu.item())
+            # Write res (as detached tensors: .item() would force a GPU sync every step)
+            self.add_results(losses_l=Ll.detach())
+            self.add_results(losses_u=Lu.detach())
 
             outputs_l = logits_l.detach()
 
@@ -74,7 +77,7 @@ class FixMatchController(MixMatchController):
             self.add_results(cross_entropy=cross_entropy)
 
             # Top-k accuracy
-            labeled = 1 - targets_l.eq(-1).long()
+            labeled = targets_l.ne(-1)
             top1 = accuracy(outputs_l, targets_l, labeled, top=1)
             # top5 = accuracy(outputs_l, targets_l, labeled, top=5)
             self.add_results(acc_top1=top1)
@@ -83,14 +86,15 @@ class FixMatchController(MixMatchController):
             f1 = f1_score(outputs_l, targets_l)
             self.add_results(f1_score=f1)
 
-    def build(self, ema_decay: float = 0.999, early_stopping: dict = None, run_hash=None, log_to_mlflow=True,
-              type_of_run=None, *args, **kwargs):
+    def build(self, ema_decay: float = 0.999, early_stopping: dict = None, print_summary=False, run_hash=None,
+              log_to_mlflow=True, type_of_run=None, *args, **kwargs):
         """
         :param early_stopping: Parameters for early stopping
         :param type_of_run: Type of run to log to mlflow (as a tag): hyperparam_search, varying_number_of_labels, None
         :param run_hash: MD5 hash of hyperparameters string for effective hyperparameter search
         :param log_to_mlflow: Log run to mlflow
         :param ema_decay: Exponential moving average decay rate
+        :param print_summary: Print the torchsummary model summary (runs an extra dummy forward)
         """
         cudnn.benchmark = True
 
@@ -101,15 +105,39 @@ class FixMatchController(MixMatchController):
 
         classifier = WideResNet_50_2(num_classes=self.get_dims('data.targets'), pretrained=False)
         ema_classifier = WideResNet_50_2(num_classes=self.get_dims('data.targets'), pretrained=False)
-        if torch.cuda.device_count() > 1:
-            print("Let's use", torch.cuda.device_count(), "GPUs!")
-            exp.DEVICE_IDS = [i for i in range(torch.cuda.device_count())]
-            self.nets.classifier = DataParallel(classifier)
-            self.nets.ema_classifier = DataParallel(ema_classifier)
+        # multi-GPU via DDP (one process per GPU, launched with torchrun): gradient all-reduce
+        # overlaps with backward instead of DataParallel's per-step scatter/gather under the GIL
+        if dist.is_available() and int(os.environ.get('WORLD_SIZE', '1')) > 1:
+            if not dist.is_initialized():
+                dist.init_process_group(backend='nccl')
+            local_rank = int(os.environ.get('LOCAL_RANK', '0'))
+            torch.cuda.set_device(local_rank)
+            # cortex places batches and constants on exp.DEVICE; point it at this rank's GPU
+            exp.DEVICE = torch.device('cuda', local_rank)
+            if dist.get_rank() == 0:
+                print("Let's use", dist.get_world_size(), "GPUs!")
+            # one mlflow run for the whole job, not one per rank
+            log_to_mlflow = log_to_mlflow and dist.get_rank() == 0
+            self.nets.classifier = DistributedDataParallel(classifier.to(local_rank), device_ids=[local_rank],
+                                                           broadcast_buffers=False, find_unused_parameters=False)
+            # EMA weights are updated identically on every rank, no need to wrap — but their
+            # initial state is rank-local, and WeightEMA copies it into the live classifier,
+            # which would undo DDP's broadcast of rank 0's weights; sync it first
+            self.nets.ema_classifier = ema_classifier.to(local_rank)
+            for tensor in ema_classifier.state_dict().values():
+                dist.broadcast(tensor, src=0)
+            # NOTE the cortex loaders are not sharded per rank yet: every rank still draws from
+            # the full dataset, so ranks differ only through shuffling
         else:
             self.nets.classifier = classifier
             self.nets.ema_classifier = ema_classifier
-        print(summary(self.nets.classifier, input_shape))
+
+        # after device selection, so the side stream lives on this rank's GPU
+        self._init_ema_stream()
+        self._zero_loss = torch.zeros((), device=exp.DEVICE)
+
+        if print_summary:
+            print(summary(self.nets.classifier, input_shape))
 
         for param in self.nets.ema_classifier.parameters():
             param.detach_()
@@ -117,7 +145,7 @@ class FixMatchController(MixMatchController):
         self.ema_optimizer = WeightEMA(self.nets.classifier, self.nets.ema_classifier, alpha=exp.ARGS['model']['ema_decay'])
         if early_stopping is not None:
             self.early_stopping = EarlyStopping(**early_stopping)
-        self.criterion = torch.nn.CrossEntropyLoss()
+        self.criterion = torch.nn.CrossEntropyLoss(ignore_index=-1)
 
         if log_to_mlflow:
             MlflowLogger.start_run(exp.INFO['name'] + '_FixMatch')
@@ -32,12 +32,12 @@ class FullSupervisedController(MixMatchController):
 
         # Top-k accuracy
         with torch.no_grad():
-            labeled = 1 - targets.eq(-1).long()
+            labeled = targets.ne(-1)
             top1 = accuracy(outputs, targets, labeled, top=1)
             self.add_results(acc_top1=top1)
 
     def build(self, pretrained=False, freeze_layers=None, ema_decay: float = 0.999, log_to_mlflow=True,
-              early_stopping: dict = None, type_of_run=None, run_hash=None, *args, **kwargs):
+              early_stopping: dict = None, print_summary=False, type_of_run=None, run_hash=None, *args, **kwargs):
         """
         :param run_hash: MD5 hash of hyperparameters string for effective hyperparameter search
         :param type_of_run: Type of run to log to mlflow (as a tag): hyperparam_search, varying_number_of_labels, None
@@ -46,8 +46,10 @@ class FullSupervisedController(MixMatchController):
         :param pretrained: Use pretrained on ImageNet encoder
         :param ema_decay: Exponential moving average decay rate
         :param log_to_mlflow: Log run to mlflow
+        :param print_summary: Print the torchsummary model summary (runs an extra dummy forward)
         """
         cudnn.benchmark = True
+        self._init_ema_stream()
 
         # Reset the data iterator and draw batch to perform shape inference.
         self.data.reset(mode='test', make_pbar=False)
@@ -58,7 +60,8 @@ class FullSupervisedController(MixMatchController):
                                                freeze_layers=freeze_layers)
         self.nets.ema_classifier = WideResNet_50_2(num_classes=self.get_dims('data.targets'), pretrained=pretrained,
                                                    freeze_layers=freeze_layers)
-        print(summary(self.nets.classifier, input_shape))
+        if print_summary:
+            print(summary(self.nets.classifier, input_shape))
 
         self.ema_optimizer = WeightEMA(self.nets.classifier, self.nets.ema_classifier, alpha=ema_decay)
         self.criterion = torch.nn.CrossEntropyLoss()
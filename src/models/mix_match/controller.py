@@ -1,13 +1,13 @@
+import math
+
 import mlflow
 import torch
 from cortex.plugins import ModelPlugin
 from cortex._lib import exp
 from torch.backends import cudnn
 import torch.nn.functional as F
-import numpy as np
 from torchsummary import summary
 
-from src.models.mix_match.utils import interleave
 from src.models.utils import accuracy, MlflowLogger, WeightEMA, EarlyStopping, f1_score
 from src.models.wideresnet import WideResNet_50_2
 
@@ -21,8 +21,30 @@ class MixMatchController(ModelPlugin):
 
     # TODO Not exactly the same batches, as in MixMatch
     def optimizer_step(self, retain_graph=False):
+        if self._ema_stream is None:
+            super().optimizer_step(retain_graph)
+            self.ema_optimizer.step()
+            return
+
+        # the in-flight EMA update still reads the params; they must not be rewritten before it is done
+        torch.cuda.current_stream().wait_event(self._ema_event)
         super().optimizer_step(retain_graph)
-        self.ema_optimizer.step()
+
+        # weight decay rewrites the live params, so it stays ordered with the training stream;
+        # the EMA shadow update only reads them and can hide behind the next iteration's forward
+        self.ema_optimizer.decay_weights()
+        self._ema_stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(self._ema_stream):
+            self.ema_optimizer.ema_update()
+        self._ema_event.record(self._ema_stream)
+
+    def _init_ema_stream(self):
+        if torch.cuda.is_available():
+            self._ema_stream = torch.cuda.Stream()
+            self._ema_event = torch.cuda.Event()
+            self._ema_event.record()  # signaled, so the first wait is a no-op
+        else:
+            self._ema_stream = None
 
     def routine(self, T: float = 0.75, alpha: float = 0.5, *args, **kwargs):
         """
@@ -33,9 +55,9 @@ class MixMatchController(ModelPlugin):
             targets_l = self.inputs('data.targets')
             inputs_l = self.inputs('data.images')
 
-            self.losses.classifier = torch.tensor(0.0).to(exp.DEVICE)
+            self.losses.classifier = self._zero_loss
 
-            with torch.no_grad():
+            with torch.no_grad(), torch.autocast('cuda', dtype=torch.bfloat16, enabled=self._autocast):
                 outputs_l = self.nets.ema_classifier(inputs_l)
 
         else:
@@ -43,80 +65,90 @@ class MixMatchController(ModelPlugin):
             inputs_l = self.inputs('data_l.images')
             inputs_u1, inputs_u2 = self.inputs('data_u.images')
 
-            # Transform label to one-hot
-            targets_l_oh = torch.zeros(self.data.batch_size['train'], self.get_dims('data.targets'))
-            targets_l_oh[range(targets_l_oh.shape[0]), targets_l] = 1.0
-            targets_l_oh = targets_l_oh.to(exp.DEVICE)
-
-            with torch.no_grad():
-                # compute guessed labels of unlabel samples
-                outputs_u1 = self.nets.classifier(inputs_u1)
-                outputs_u2 = self.nets.classifier(inputs_u2)
-                p = (torch.softmax(outputs_u1, dim=1) + torch.softmax(outputs_u2, dim=1)) / 2
-                pt = p ** (1 / T)
-                targets_u = pt / pt.sum(dim=1, keepdim=True)
-                targets_u = targets_u.detach()
-
-            # mixup
-            all_inputs = torch.cat([inputs_l, inputs_u1, inputs_u2], dim=0)
+            # Transform label to one-hot (on device, no host-side scatter + H2D copy)
+            targets_l_oh = F.one_hot(targets_l.to(exp.DEVICE), num_classes=self.get_dims('data.targets')).float()
+
+            with torch.no_grad(), torch.autocast('cuda', dtype=torch.bfloat16, enabled=self._autocast):
+                # compute guessed labels of unlabel samples (both augmentations in one forward)
+                outputs_u = self.nets.classifier(torch.cat([inputs_u1, inputs_u2], dim=0))
+                outputs_u1, outputs_u2 = outputs_u[:inputs_u1.size(0)], outputs_u[inputs_u1.size(0):]
+                # sharpen in log-space: p**(1/T) / sum(p**(1/T)) == softmax(log(p) / T),
+                # with log(p) = logsumexp(log_softmax(o1), log_softmax(o2)) - log(2)
+                log_p = torch.stack([F.log_softmax(outputs_u1, dim=1),
+                                     F.log_softmax(outputs_u2, dim=1)]).logsumexp(dim=0) - math.log(2)
+                targets_u = F.softmax(log_p / T, dim=1).detach()
+
+            # mixup (concatenate into a persistent buffer; shapes are constant since skip_last_batch=True)
+            n_all = inputs_l.size(0) + inputs_u1.size(0) + inputs_u2.size(0)
+            if self._all_inputs is None or self._all_inputs.shape[0] != n_all:
+                self._all_inputs = torch.empty((n_all, *inputs_l.shape[1:]), dtype=inputs_l.dtype,
+                                               device=inputs_l.device, memory_format=torch.channels_last)
+            all_inputs = torch.cat([inputs_l, inputs_u1, inputs_u2], dim=0, out=self._all_inputs)
             all_targets = torch.cat([targets_l_oh, targets_u, targets_u], dim=0)
 
-            l = np.random.beta(alpha, alpha)
-            l = max(l, 1 - l)
-
-            idx = torch.randperm(all_inputs.size(0))
-            input_a, input_b = all_inputs, all_inputs[idx]
-            target_a, target_b = all_targets, all_targets[idx]
-
-            mixed_input = l * input_a + (1 - l) * input_b
-            mixed_target = l * target_a + (1 - l) * target_b
-
-            # interleave labeled and unlabed samples between batches to get correct batchnorm calculation
-            mixed_input = list(torch.split(mixed_input, self.data.batch_size['train']))
-            mixed_input = interleave(mixed_input, self.data.batch_size['train'])
-
-            logits = [self.nets.classifier(mixed_input[0])]
-            for input in mixed_input[1:]:
-                logits.append(self.nets.classifier(input))
-
-            # put interleaved samples back
-            logits = interleave(logits, self.data.batch_size['train'])
-            logits_l = logits[0]
-            logits_u = torch.cat(logits[1:], dim=0)
-
+            # prefetch a block of mixup lambdas: one Beta draw per step is a separate kernel
+            # launch, sampling 64 at once amortizes it across as many iterations
+            if self._lambdas is None or self._lambda_idx >= self._lambdas.size(0):
+                if self._beta is None:
+                    self._beta = torch.distributions.Beta(torch.tensor(alpha, device=exp.DEVICE),
+                                                          torch.tensor(alpha, device=exp.DEVICE))
+                lambdas = self._beta.sample((64,))
+                self._lambdas = torch.maximum(lambdas, 1 - lambdas)
+                self._lambda_idx = 0
+            l = self._lambdas[self._lambda_idx]
+            self._lambda_idx = self._lambda_idx + 1
+
+            idx = torch.randperm(all_inputs.size(0), device=all_inputs.device)
+
+            # l * a + (1 - l) * b == lerp(b, a, l), fused into one kernel
+            mixed_input = torch.lerp(all_inputs[idx], all_inputs, l)
+            mixed_target = torch.lerp(all_targets[idx], all_targets, l)
+
+            # single batched forward over all sub-batches (one kernel launch, BN over 3xBS samples);
+            # no interleaving needed, BN statistics are computed over the whole mixed batch anyway
+            BS = self.data.batch_size['train']
             all_data_steps = len(self.data.loaders['data_l']['train'])
-            Ll, Lu, w = self.loss(logits_l, mixed_target[:self.data.batch_size['train']],
-                                  logits_u, mixed_target[self.data.batch_size['train']:],
-                                  exp.INFO['data_steps'] / all_data_steps)
+            with torch.autocast('cuda', dtype=torch.bfloat16, enabled=self._autocast):
+                logits = self.nets.classifier(mixed_input)
+                logits_l = logits[:BS]
+                logits_u = logits[BS:]
+
+                Ll, Lu, w = self.loss(logits_l, mixed_target[:BS],
+                                      logits_u, mixed_target[BS:],
+                                      exp.INFO['data_steps'] / all_data_steps)
 
             # record loss
             self.losses.classifier = Ll + w * Lu
 
-            # Write res
-            self.add_results(losses_l=Ll.item())
-            self.add_results(losses_u=Lu.item())
+            # Write res (as detached tensors: .item() would force a GPU sync every step)
+            self.add_results(losses_l=Ll.detach())
+            self.add_results(losses_u=Lu.detach())
             self.add_results(w=w)
 
+        # Metrics only on val/test: the training step no longer pays an extra labeled forward
+        if self.data.mode == 'test' or self.data.mode == 'val':
             with torch.no_grad():
-                outputs_l = self.nets.classifier(inputs_l)
+                labeled = targets_l.ne(-1)
 
-        # Cross-entropy
-        with torch.no_grad():
-            cross_entropy = self.criterion(outputs_l, targets_l)
-            self.add_results(cross_entropy=cross_entropy)
+                # Cross-entropy as masked sparse NLL: -1 marks unlabeled samples and must not
+                # index the log-probabilities
+                log_probs = F.log_softmax(outputs_l, dim=1)
+                nll = -log_probs.gather(1, targets_l.clamp(min=0).unsqueeze(1)).squeeze(1)
+                cross_entropy = (nll * labeled).sum() / labeled.sum().clamp(min=1)
+                self.add_results(cross_entropy=cross_entropy)
 
-            # Top-k accuracy
-            labeled = 1 - targets_l.eq(-1).long()
-            top1 = accuracy(outputs_l, targets_l, labeled, top=1)
-            # top5 = accuracy(outputs_l, targets_l, labeled, top=5)
-            self.add_results(acc_top1=top1)
+                # Top-k accuracy
+                top1 = accuracy(outputs_l, targets_l, labeled, top=1)
+                # top5 = accuracy(outputs_l, targets_l, labeled, top=5)
+                self.add_results(acc_top1=top1)
 
-            # F1-score
-            f1 = f1_score(outputs_l, targets_l)
-            self.add_results(f1_score=f1)
+                # F1-score
+                f1 = f1_score(outputs_l, targets_l)
+                self.add_results(f1_score=f1)
 
     def build(self, lambda_u: float = 12.5, ema_decay: float = 0.999, early_stopping: dict = None, pretrained=False,
-              run_hash=None, log_to_mlflow=True, type_of_run=None, *args, **kwargs):
+              compile_model=True, autocast=True, print_summary=False, run_hash=None, log_to_mlflow=True,
+              type_of_run=None, *args, **kwargs):
         """
         :param early_stopping: Parameters for early stopping
         :param type_of_run: Type of run to log to mlflow (as a tag): hyperparam_search, varying_number_of_labels, None
@@ -125,8 +157,18 @@ class MixMatchController(ModelPlugin):
         :param ema_decay: Exponential moving average decay rate
         :param lambda_u: Unlabeled loss weight
         :param pretrained: Use pretrained on ImageNet encoder, freezing all the layers except last
+        :param compile_model: Compile the classifiers with torch.compile (requires torch >= 2.0)
+        :param autocast: Run forwards under bfloat16 autocast (skipped when the GPU has no bf16 support)
+        :param print_summary: Print the torchsummary model summary (runs an extra dummy forward)
         """
         cudnn.benchmark = True
+        self._autocast = autocast and torch.cuda.is_available() and torch.cuda.is_bf16_supported()
+        self._all_inputs = None  # reusable buffer for the concatenated mixup batch
+        self._lambdas = None  # prefetched block of mixup lambdas
+        self._lambda_idx = 0
+        self._beta = None  # cached on-device Beta distribution for mixup
+        self._zero_loss = torch.zeros((), device=exp.DEVICE)
+        self._init_ema_stream()
 
         # Reset the data iterator and draw batch to perform shape inference.
         self.data.reset(mode='test', make_pbar=False)
@@ -135,7 +177,12 @@ class MixMatchController(ModelPlugin):
 
         self.nets.classifier = WideResNet_50_2(num_classes=self.get_dims('data.targets'), pretrained=pretrained)
         self.nets.ema_classifier = WideResNet_50_2(num_classes=self.get_dims('data.targets'), pretrained=pretrained)
-        print(summary(self.nets.classifier, input_shape))
+        if print_summary:
+            print(summary(self.nets.classifier, input_shape))
+
+        if compile_model and hasattr(torch, 'compile'):
+            self.nets.classifier = torch.compile(self.nets.classifier)
+            self.nets.ema_classifier = torch.compile(self.nets.ema_classifier)
 
         for param in self.nets.ema_classifier.parameters():
             param.detach_()
@@ -144,7 +191,6 @@ class MixMatchController(ModelPlugin):
         if early_stopping is not None:
             self.early_stopping = EarlyStopping(**early_stopping)
         self.loss = SemiLoss(exp.ARGS['model']['lambda_u'], exp.ARGS['train']['epochs'])
-        self.criterion = torch.nn.CrossEntropyLoss()
 
         if log_to_mlflow:
             MlflowLogger.start_run(exp.INFO['name'] + '_MixMatch')
@@ -160,6 +206,10 @@ class MixMatchController(ModelPlugin):
             mlflow.log_param('pretrained', pretrained)
 
     def eval_loop(self):
+        # the EMA classifier may still be updating on the side stream
+        if self._ema_stream is not None:
+            torch.cuda.current_stream().wait_stream(self._ema_stream)
+
         # Evaluation
         self.data.reset(mode='val')
         super().eval_loop()
@@ -219,9 +269,7 @@ class SemiLoss:
     def linear_rampup(current, rampup_length):
         if rampup_length == 0:
             return 1.0
-        else:
-            current = np.clip(current / rampup_length, 0.0, 1.0)
-            return float(current)
+        return min(max(current / rampup_length, 0.0), 1.0)
 
     def __call__(self, outputs_x, targets_x, outputs_u, targets_u, epoch):
         probs_u = torch.softmax(outputs_u, dim=1)
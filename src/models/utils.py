@@ -94,21 +94,30 @@ class WeightEMA(object):
         self.model = model
         self.ema_model = ema_model
         self.alpha = alpha
-        self.params = list(model.state_dict().values())
-        self.ema_params = list(ema_model.state_dict().values())
+        params = list(model.state_dict().values())
+        ema_params = list(ema_model.state_dict().values())
         self.wd = 0.02 * exp.ARGS['optimizer']['learning_rate']
 
-        for param, ema_param in zip(self.params, self.ema_params):
+        for param, ema_param in zip(params, ema_params):
             param.data.copy_(ema_param.data)
 
+        # EMA only tracks float tensors; int buffers (e.g. BN num_batches_tracked) are left as is
+        self.params = [param for param in params
+                       if param.dtype.is_floating_point and len(param.shape) > 0]
+        self.ema_params = [ema_param for param, ema_param in zip(params, ema_params)
+                           if param.dtype.is_floating_point and len(param.shape) > 0]
+
+    def ema_update(self):
+        # ema = alpha * ema + (1 - alpha) * param, as a single fused pass per tensor
+        torch._foreach_lerp_(self.ema_params, self.params, 1.0 - self.alpha)
+
+    def decay_weights(self):
+        # customized weight decay
+        torch._foreach_mul_(self.params, 1 - self.wd)
+
     def step(self):
-        one_minus_alpha = 1.0 - self.alpha
-        for param, ema_param in zip(self.params, self.ema_params):
-            if len(param.shape) > 0:
-                ema_param.mul_(self.alpha)
-                ema_param.add_(param * one_minus_alpha)
-                # customized weight decay
-                param.mul_(1 - self.wd)
+        self.decay_weights()
+        self.ema_update()
 
 
 class EarlyStopping(object):
@@ -143,7 +152,7 @@ def accuracy(outputs: torch.Tensor, targets: torch.Tensor, labeled, top: int = 1
     Args:
         :param is_argmax:
         :param targets: Targets for each input.
-        :param labeled: Binary variable indicating whether a target exists.
+        :param labeled: Boolean mask indicating whether a target exists.
         :param top: Top-K accuracy.
         :param outputs: Classifier outputs.
 
@@ -157,7 +166,7 @@ def accuracy(outputs: torch.Tensor, targets: torch.Tensor, labeled, top: int = 1
         correct = labeled.float() * pred.eq(targets.view(1, -1).expand_as(pred)).float()
 
         correct_k = correct[:top].view(-1).float().sum(0, keepdim=True)
-        accuracy = correct_k.mul_(100.0 / labeled.float().sum())
+        accuracy = correct_k.mul_(100.0 / torch.count_nonzero(labeled))
         return accuracy.detach().item()
 
 
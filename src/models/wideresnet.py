@@ -11,6 +11,8 @@ class WideResNet_50_2(nn.Module):
         self.wrn = torch.hub.load('pytorch/vision:v0.5.0', 'wide_resnet50_2', pretrained=pretrained)
         self.wrn.eval()
         self.wrn.fc = nn.Linear(self.wrn.fc.in_features, num_classes)
+        # NHWC layout: conv/BN-heavy forwards pick TensorCore-friendly cudnn kernels
+        self.wrn = self.wrn.to(memory_format=torch.channels_last)
         if self.freeze_layers:
             for name, param in self.wrn.named_parameters():
                 if name == 'fc.weight' or name == 'fc.bias':
@@ -19,4 +21,4 @@ class WideResNet_50_2(nn.Module):
                     param.requires_grad = False
 
     def forward(self, x):
-        return self.wrn(x)
+        return self.wrn(x.contiguous(memory_format=torch.channels_last))